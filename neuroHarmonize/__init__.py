@@ -1,3 +1,3 @@
-from .harmonizationLearn import harmonizationLearn, saveHarmonizationModel
+from .harmonizationLearn import harmonizationLearn, saveHarmonizationModel, prepareHarmonizationDesign, harmonizationLearnWithDesign
 from .harmonizationApply import harmonizationApply, loadHarmonizationModel
 #from .harmonizationNIFTI.py import create_NIFTI_mask, flatten_NIFTIs
\ No newline at end of file
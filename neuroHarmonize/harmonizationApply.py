@@ -1,4 +1,5 @@
 import os
+import gzip
 import pickle
 import numpy as np
 import pandas as pd
@@ -31,28 +32,33 @@ def harmonizationApply(data, covars, model):
         harmonized data, dimensions are N_samples x N_features
         
     """
-    # transpose data as per ComBat convention
-    data = data.T
+    # transpose data as per ComBat convention, in the precision of the model
+    # copied once to C order, so data.T is passed to BLAS without further copies
+    data = np.ascontiguousarray(np.asarray(data).T, dtype=model['B_hat'].dtype)
     # prep covariate data
-    batch_labels = np.unique(covars.SITE)
     batch_col = covars.columns.get_loc('SITE')
     cat_cols = []
     num_cols = [covars.columns.get_loc(c) for c in covars.columns if c!='SITE']
-    covars = np.array(covars, dtype='object')
+    # encode SITE as integer codes so covariates can be stored as a numeric array
+    # labels are sorted, so codes are consistent between training and holdout data
+    batch_codes, batch_labels = pd.factorize(covars['SITE'], sort=True)
+    batch_labels = np.asarray(batch_labels)
+    covars = covars.assign(SITE=batch_codes).to_numpy(dtype=np.float64)
     # load the smoothing model
     smooth_model = model['smooth_model']
     smooth_cols = smooth_model['smooth_cols']
     ### additional setup code from neuroCombat implementation:
-    # convert batch col to integer
-    covars[:,batch_col] = np.unique(covars[:,batch_col],return_inverse=True)[-1]
     # create dictionary that stores batch info
-    (batch_levels, sample_per_batch) = np.unique(covars[:,batch_col],return_counts=True)
+    batch_levels = np.arange(len(batch_labels))
+    sample_per_batch = np.bincount(batch_codes, minlength=len(batch_labels))
+    # sample indices of each batch, from a single stable sort of the batch column
+    batch_order = np.argsort(batch_codes, kind='stable')
     info_dict = {
         'batch_levels': batch_levels.astype('int'),
         'n_batch': len(batch_levels),
         'n_sample': int(covars.shape[0]),
         'sample_per_batch': sample_per_batch.astype('int'),
-        'batch_info': [list(np.where(covars[:,batch_col]==idx)[0]) for idx in batch_levels]
+        'batch_info': np.split(batch_order, np.cumsum(sample_per_batch)[:-1])
     }
     ###
     # check sites are identical in training dataset
@@ -67,20 +73,14 @@ def harmonizationApply(data, covars, model):
     ### additional setup if smoothing is performed
     if smooth_model['perform_smoothing']:
         # create cubic spline basis for smooth terms
-        X_spline = covars[:, smooth_cols].astype(float)
+        X_spline = covars[:, smooth_cols]
         bs_basis = smooth_model['bsplines_constructor'].transform(X_spline)
         # construct formula and dataframe required for gam
-        formula = 'y ~ '
-        df_gam = {}
-        for b in batch_levels:
-            formula = formula + 'x' + str(b) + ' + '
-            df_gam['x' + str(b)] = design[:, b]
-        for c in num_cols:
-            if c not in smooth_cols:
-                formula = formula + 'c' + str(c) + ' + '
-                df_gam['c' + str(c)] = covars[:, c].astype(float)
-        formula = formula[:-2] + '- 1'
-        df_gam = pd.DataFrame(df_gam)
+        linear_cols = [c for c in num_cols if c not in smooth_cols]
+        terms = ['x' + str(b) for b in batch_levels] + ['c' + str(c) for c in linear_cols]
+        formula = 'y ~ ' + ' + '.join(terms) + ' - 1'
+        df_gam = pd.DataFrame(np.column_stack((design[:, batch_levels], covars[:, linear_cols])),
+                              columns=terms)
         # check formulas are identical in training dataset
         check_formula = formula==smooth_model['formula']
         if not check_formula:
@@ -88,9 +88,11 @@ def harmonizationApply(data, covars, model):
         # for matrix operations, a modified design matrix is required
         design = np.concatenate((df_gam, bs_basis), axis=1)
     ###
+    design = np.asfortranarray(design, dtype=model['B_hat'].dtype)
     s_data, stand_mean, var_pooled = applyStandardizationAcrossFeatures(data, design, info_dict, model)
     bayes_data = adjust_data_final(s_data, design, model['gamma_star'], model['delta_star'],
                                    stand_mean, var_pooled, info_dict)
+    bayes_data = bayes_data.astype(model['B_hat'].dtype, copy=False)
     # transpose data to return to original shape
     bayes_data = bayes_data.T
     
@@ -112,12 +114,16 @@ def applyStandardizationAcrossFeatures(X, design, info_dict, model):
     grand_mean = model['grand_mean']
     var_pooled = model['var_pooled']
 
-    stand_mean = np.dot(grand_mean.T.reshape((len(grand_mean), 1)), np.ones((1, n_sample)))
-    tmp = np.array(design.copy())
-    tmp[:,:n_batch] = 0
-    stand_mean  += np.dot(tmp, B_hat).T
+    # grand mean is broadcast across samples rather than expanded
+    stand_mean = grand_mean.reshape((-1, 1))
+    # skip the covariate term if the design only contains SITE
+    if design.shape[1] > n_batch:
+        stand_mean = stand_mean + np.dot(design[:, n_batch:], B_hat[n_batch:, :]).T
     
-    s_data = ((X- stand_mean) / np.dot(np.sqrt(var_pooled), np.ones((1, n_sample))))
+    # multiply by the reciprocal pooled SD, a column vector broadcast across samples
+    inv_sd = 1.0 / np.sqrt(var_pooled)
+    s_data = X - stand_mean
+    s_data *= inv_sd
 
     return s_data, stand_mean, var_pooled
 
@@ -140,7 +146,7 @@ def applyModelOne(data, covars, model):
     batch_col = covars.columns.get_loc('SITE')
     cat_cols = []
     num_cols = [covars.columns.get_loc(c) for c in covars.columns if c!='SITE']
-    covars = np.array(covars, dtype='object')
+    covars = covars.assign(SITE=pd.factorize(covars['SITE'])[0]).to_numpy(dtype=np.float64)
     # apply design matrix construction (needs to be modified)
     design_i = make_design_matrix(covars, batch_col, cat_cols, num_cols)
     # encode batches as in larger dataset
@@ -159,9 +165,7 @@ def applyModelOne(data, covars, model):
     var_pooled = model['var_pooled']
 
     stand_mean = np.dot(grand_mean.T.reshape((len(grand_mean), 1)), np.ones((1, n_sample)))
-    tmp = np.array(D.copy())
-    tmp[:,:n_batch] = 0
-    stand_mean += np.dot(tmp, B_hat).T
+    stand_mean += np.dot(D[:, n_batch:], B_hat[n_batch:, :]).T
 
     s_data = ((X- stand_mean) / np.dot(np.sqrt(var_pooled), np.ones((1, n_sample))))
 
@@ -188,11 +192,20 @@ def loadHarmonizationModel(file_name):
     """
     For loading model contents, this function will load a model specified
     by file_name using the pickle package.
+    
+    Models saved with saveHarmonizationModel(compress=True) are detected and
+    decompressed automatically.
     """
     if not os.path.exists(file_name):
         raise ValueError('Model file does not exist: %s. Did you run `saveHarmonizationModel`?' % file_name)
     in_file = open(file_name,'rb')
+    # gzip files start with the magic number 1f 8b
+    if in_file.read(2) == b'\x1f\x8b':
+        in_file.close()
+        in_file = gzip.open(file_name, 'rb')
+    else:
+        in_file.seek(0)
     model = pickle.load(in_file)
     in_file.close()
     
-    return model
\ No newline at end of file
+    return model
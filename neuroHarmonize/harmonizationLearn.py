@@ -1,12 +1,23 @@
 import os
+import gzip
 import pickle
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+from scipy.linalg import block_diag, cho_factor, cho_solve, LinAlgError
+from scipy.linalg.blas import get_blas_funcs
+from scipy.optimize import minimize
 from statsmodels.gam.api import GLMGam, BSplines
 from .neuroCombat import make_design_matrix, find_parametric_adjustments, adjust_data_final, aprior, bprior
 
+# minimum number of features for which the numba implementation is used
+NUMBA_MIN_FEATURES = 1000
+# search range of the log penalization weights of GAMs
+LOG_ALPHA_BOUNDS = (-10.0, 30.0)
+
 def harmonizationLearn(data, covars, eb=True, smooth_terms=[],
-                       smooth_term_bounds=(None, None), return_s_data=False):
+                       smooth_term_bounds=(None, None), return_s_data=False,
+                       per_feature_gam=False, n_jobs=1, dtype=None):
     """
     Wrapper for neuroCombat function that returns the harmonization model.
     
@@ -41,6 +52,20 @@ def harmonizationLearn(data, covars, eb=True, smooth_terms=[],
         whether to return s_data, the standardized data array
         can be useful for diagnostics but will be costly to save/load if large
         
+    per_feature_gam (Optional) : bool, default False
+        whether to fit a separate statsmodels GAM for each feature
+        by default, all features are fit at once with a shared penalization
+        weight selected by GCV; the per-feature fit is much slower
+        
+    n_jobs (Optional) : int, default 1
+        number of parallel jobs for the per-feature GAM fit
+        only used if per_feature_gam=True, use -1 for all available cores
+        
+    dtype (Optional) : a numpy floating point type, default None
+        precision used for computation, e.g. np.float32 to halve memory use
+        if None, the type of data is used, promoted to at least float32
+        B_hat, grand_mean, var_pooled and bayes_data are returned in this type
+        
     Returns
     -------
     model : a dictionary of estimated model parameters
@@ -57,10 +82,33 @@ def harmonizationLearn(data, covars, eb=True, smooth_terms=[],
         set return_s_data=True to output the variable
     
     """
-    # transpose data as per ComBat convention
-    data = data.T
+    if dtype is None:
+        dtype = np.promote_types(data.dtype, np.float32)
+    context = prepareHarmonizationDesign(covars, smooth_terms=smooth_terms,
+                                         smooth_term_bounds=smooth_term_bounds,
+                                         per_feature_gam=per_feature_gam, dtype=dtype)
+    
+    return harmonizationLearnWithDesign(data, context, eb=eb, return_s_data=return_s_data,
+                                        n_jobs=n_jobs)
+
+def prepareHarmonizationDesign(covars, smooth_terms=[], smooth_term_bounds=(None, None),
+                               per_feature_gam=False, dtype=np.float64):
+    """
+    Prepare the design matrix of a harmonization model from covariates only.
+    
+    The result can be passed to harmonizationLearnWithDesign() to harmonize
+    several data arrays with the same covariates, e.g. subsets of features,
+    without rebuilding and refactoring the design matrix each time.
+    Arguments are as in harmonizationLearn().
+    
+    Returns
+    -------
+    context : a dictionary
+        design, design_factor (Cholesky factor of design'design, None if
+        smoothing is performed), SITE_labels, info_dict, smooth_model
+    
+    """
     # prep covariate data
-    batch_labels = np.unique(covars.SITE)
     batch_col = covars.columns.get_loc('SITE')
     cat_cols = []
     num_cols = [covars.columns.get_loc(c) for c in covars.columns if c!='SITE']
@@ -72,41 +120,42 @@ def harmonizationLearn(data, covars, eb=True, smooth_terms=[],
         'smooth_cols': smooth_cols,
         'bsplines_constructor': None,
         'formula': None,
-        'df_gam': None
+        'df_gam': None,
+        'per_feature_gam': per_feature_gam,
+        'alpha': None
     }
-    covars = np.array(covars, dtype='object')
+    # encode SITE as integer codes so covariates can be stored as a numeric array
+    # labels are sorted, so codes are consistent between training and holdout data
+    batch_codes, batch_labels = pd.factorize(covars['SITE'], sort=True)
+    batch_labels = np.asarray(batch_labels)
+    covars = covars.assign(SITE=batch_codes).to_numpy(dtype=np.float64)
     ### additional setup code from neuroCombat implementation:
-    # convert batch col to integer
-    covars[:,batch_col] = np.unique(covars[:,batch_col],return_inverse=True)[-1]
     # create dictionary that stores batch info
-    (batch_levels, sample_per_batch) = np.unique(covars[:,batch_col],return_counts=True)
+    batch_levels = np.arange(len(batch_labels))
+    sample_per_batch = np.bincount(batch_codes, minlength=len(batch_labels))
+    # sample indices of each batch, from a single stable sort of the batch column
+    batch_order = np.argsort(batch_codes, kind='stable')
     info_dict = {
         'batch_levels': batch_levels.astype('int'),
         'n_batch': len(batch_levels),
         'n_sample': int(covars.shape[0]),
         'sample_per_batch': sample_per_batch.astype('int'),
-        'batch_info': [list(np.where(covars[:,batch_col]==idx)[0]) for idx in batch_levels]
+        'batch_info': np.split(batch_order, np.cumsum(sample_per_batch)[:-1])
     }
     ###
     design = make_design_matrix(covars, batch_col, cat_cols, num_cols)
     ### additional setup if smoothing is performed
     if smooth_model['perform_smoothing']:
         # create cubic spline basis for smooth terms
-        X_spline = covars[:, smooth_cols].astype(float)
+        X_spline = covars[:, smooth_cols]
         bs = BSplines(X_spline, df=[10] * len(smooth_cols), degree=[3] * len(smooth_cols),
                       knot_kwds=[{'lower_bound':smooth_term_bounds[0], 'upper_bound':smooth_term_bounds[1]}])
         # construct formula and dataframe required for gam
-        formula = 'y ~ '
-        df_gam = {}
-        for b in batch_levels:
-            formula = formula + 'x' + str(b) + ' + '
-            df_gam['x' + str(b)] = design[:, b]
-        for c in num_cols:
-            if c not in smooth_cols:
-                formula = formula + 'c' + str(c) + ' + '
-                df_gam['c' + str(c)] = covars[:, c].astype(float)
-        formula = formula[:-2] + '- 1'
-        df_gam = pd.DataFrame(df_gam)
+        linear_cols = [c for c in num_cols if c not in smooth_cols]
+        terms = ['x' + str(b) for b in batch_levels] + ['c' + str(c) for c in linear_cols]
+        formula = 'y ~ ' + ' + '.join(terms) + ' - 1'
+        df_gam = pd.DataFrame(np.column_stack((design[:, batch_levels], covars[:, linear_cols])),
+                              columns=terms)
         # for matrix operations, a modified design matrix is required
         design = np.concatenate((df_gam, bs.basis), axis=1)
         # store objects in dictionary
@@ -114,17 +163,54 @@ def harmonizationLearn(data, covars, eb=True, smooth_terms=[],
         smooth_model['formula'] = formula
         smooth_model['df_gam'] = df_gam
     ###
+    # column-major design matrix for the BLAS-heavy products below
+    design = np.asfortranarray(design, dtype=dtype)
+    # the linear model factorization does not depend on data, so it is cached
+    if smooth_model['perform_smoothing']:
+        design_factor = None
+    else:
+        design_factor = cho_factor(np.dot(design.T, design), lower=True, check_finite=False)
+    
+    context = {'design': design, 'design_factor': design_factor,
+               'SITE_labels': batch_labels, 'info_dict': info_dict,
+               'smooth_model': smooth_model}
+    
+    return context
+
+def harmonizationLearnWithDesign(data, context, eb=True, return_s_data=False, n_jobs=1):
+    """
+    Learn the harmonization model from data and a design prepared with
+    prepareHarmonizationDesign().
+    
+    data is cast to the type of the prepared design matrix. Other arguments
+    and return values are as in harmonizationLearn().
+    """
+    design = context['design']
+    info_dict = context['info_dict']
+    # check data matches the covariates used to prepare the design
+    if data.shape[0]!=info_dict['n_sample']:
+        raise ValueError('Number of samples in data (%d) not identical to prepared design (%d). Check `data` argument.'
+                         % (data.shape[0], info_dict['n_sample']))
+    batch_labels = context['SITE_labels']
+    # copy since the smoothing weights selected for this data are stored in it
+    smooth_model = dict(context['smooth_model'])
+    dtype = design.dtype
+    # transpose data as per ComBat convention
+    # copied once to C order, so data.T is passed to BLAS without further copies
+    data = np.ascontiguousarray(np.asarray(data).T, dtype=dtype)
     # run steps to perform ComBat
     s_data, stand_mean, var_pooled, B_hat, grand_mean = standardizeAcrossFeatures(
-        data, design, info_dict, smooth_model)
+        data, design, info_dict, smooth_model, n_jobs=n_jobs,
+        design_factor=context['design_factor'])
     LS_dict = fitLSModelAndFindPriors(s_data, design, info_dict, eb=eb)
     # optional: avoid EB estimates
     if eb:
-        gamma_star, delta_star = find_parametric_adjustments(s_data, LS_dict, info_dict)
+        gamma_star, delta_star = findParametricAdjustments(s_data, LS_dict, info_dict)
     else:
         gamma_star = LS_dict['gamma_hat']
         delta_star = np.array(LS_dict['delta_hat'])
     bayes_data = adjust_data_final(s_data, design, gamma_star, delta_star, stand_mean, var_pooled, info_dict)
+    bayes_data = bayes_data.astype(dtype, copy=False)
     # save model parameters in single object
     model = {'design': design, 'SITE_labels': batch_labels,
              'var_pooled':var_pooled, 'B_hat':B_hat, 'grand_mean': grand_mean,
@@ -141,7 +227,8 @@ def harmonizationLearn(data, covars, eb=True, smooth_terms=[],
     else:
         return model, bayes_data
 
-def standardizeAcrossFeatures(X, design, info_dict, smooth_model):
+def standardizeAcrossFeatures(X, design, info_dict, smooth_model, n_jobs=1,
+                              design_factor=None):
     """
     The original neuroCombat function standardize_across_features plus
     necessary modifications.
@@ -154,43 +241,130 @@ def standardizeAcrossFeatures(X, design, info_dict, smooth_model):
     sample_per_batch = info_dict['sample_per_batch']
 
     ### perform smoothing with GAMs if specified
-    if smooth_model['perform_smoothing']:
+    if smooth_model['perform_smoothing'] and not smooth_model['per_feature_gam']:
+        B_hat, alpha = fitGAMAcrossFeatures(X, design, smooth_model)
+        smooth_model['alpha'] = alpha
+    elif smooth_model['perform_smoothing']:
         smooth_cols = smooth_model['smooth_cols']
         bs = smooth_model['bsplines_constructor']
-        formula = smooth_model['formula']
-        df_gam = smooth_model['df_gam']
+        # linear terms of the formula, i.e. the design matrix without splines
+        exog = design[:, :design.shape[1] - bs.dim_basis]
         
         if X.shape[0] > 10:
             print('\n[neuroHarmonize]: smoothing more than 10 variables may take several minutes of computation.')
         # initialize penalization weight (not the final weight)
         alpha = np.array([1.0] * len(smooth_cols))
-        # initialize an empty matrix for beta
-        B_hat = np.zeros((design.shape[1], X.shape[0]))
-        # estimate beta for each variable to be harmonized
-        for i in range(0, X.shape[0]):
-            df_gam.loc[:, 'y'] = X[i, :]
-            gam_bs = GLMGam.from_formula(formula, data=df_gam, smoother=bs, alpha=alpha)
-            res_bs = gam_bs.fit()
-            # Optimal penalization weights alpha can be obtained through gcv/kfold
-            # Note: kfold is faster, gcv is more robust
-            gam_bs.alpha = gam_bs.select_penweight_kfold()[0]
-            res_bs_optim = gam_bs.fit()
-            B_hat[:, i] = res_bs_optim.params
+        # estimate beta for each variable to be harmonized, in parallel
+        # note: the loky backend limits BLAS threads in each worker
+        B_hat = Parallel(n_jobs=n_jobs)(
+            delayed(fitGAMOneFeature)(X[i, :], exog, bs, alpha) for i in range(0, X.shape[0]))
+        B_hat = np.column_stack(B_hat).astype(X.dtype, copy=False)
     ###
     else:
-        B_hat = np.dot(np.dot(np.linalg.inv(np.dot(design.T, design)), design.T), X.T)
-    grand_mean = np.dot((sample_per_batch/ float(n_sample)).T, B_hat[:n_batch,:])
-    var_pooled = np.dot(((X - np.dot(design, B_hat).T)**2), np.ones((n_sample, 1)) / float(n_sample))
+        if design_factor is None:
+            design_factor = cho_factor(np.dot(design.T, design), lower=True, check_finite=False)
+        B_hat = cho_solve(design_factor, np.dot(design.T, X.T), check_finite=False)
+    # store coefficients row-major, so the batch rows are one contiguous block
+    # and their transpose can be passed to BLAS gemv without a copy
+    B_hat = np.ascontiguousarray(B_hat)
+    gemv = get_blas_funcs('gemv', (B_hat,))
+    grand_mean = gemv(1.0, B_hat[:n_batch,:].T, (sample_per_batch / float(n_sample)).astype(X.dtype))
+    # squared residuals are computed in place in the buffer of fitted values
+    resid = np.dot(design, B_hat)
+    np.subtract(X.T, resid, out=resid)
+    np.square(resid, out=resid)
+    var_pooled = resid.mean(axis=0).reshape((-1, 1))
+    del resid
 
-    stand_mean = np.dot(grand_mean.T.reshape((len(grand_mean), 1)), np.ones((1, n_sample)))
-    tmp = np.array(design.copy())
-    tmp[:,:n_batch] = 0
-    stand_mean  += np.dot(tmp, B_hat).T
+    # grand mean is broadcast across samples rather than expanded
+    stand_mean = grand_mean.reshape((-1, 1))
+    # skip the covariate term if the design only contains SITE
+    if design.shape[1] > n_batch:
+        stand_mean = stand_mean + np.dot(design[:, n_batch:], B_hat[n_batch:, :]).T
 
-    s_data = ((X- stand_mean) / np.dot(np.sqrt(var_pooled), np.ones((1, n_sample))))
+    # multiply by the reciprocal pooled SD, a column vector broadcast across samples
+    inv_sd = 1.0 / np.sqrt(var_pooled)
+    s_data = X - stand_mean
+    s_data *= inv_sd
 
     return s_data, stand_mean, var_pooled, B_hat, grand_mean
 
+def fitGAMAcrossFeatures(X, design, smooth_model):
+    """
+    Fit the GAM for all features at once as a penalized least-squares problem
+    with multiple responses.
+    
+    The design matrix and spline basis are shared by every feature, so the
+    penalized normal equations are factored once per candidate weight. A
+    single set of penalization weights is selected by GCV on the residuals
+    pooled across features. Each feature is centered and scaled to unit
+    variance for the selection, so that neither the units nor the mean of a
+    feature affect the weights. The selection is always done in double
+    precision.
+    """
+    bs = smooth_model['bsplines_constructor']
+    n_sample = design.shape[0]
+    k_linear = design.shape[1] - bs.dim_basis
+    
+    design_64 = design.astype(np.float64)
+    DtD = np.dot(design_64.T, design_64)
+    DtY = np.dot(design.T, X.T).astype(np.float64, copy=False)
+    # standardize features for the selection of the weights; centering does
+    # not change the residuals since the site indicators span the intercept,
+    # but avoids cancellation in the residual sum of squares below
+    Y_scaled = X.astype(np.float64)
+    Y_scaled -= Y_scaled.mean(axis=1, keepdims=True)
+    sd = np.sqrt(np.mean(Y_scaled**2, axis=1, keepdims=True))
+    sd[sd == 0] = 1.0
+    Y_scaled /= sd
+    DtY_scaled = np.dot(design_64.T, Y_scaled.T)
+    YtY_scaled = np.sum(Y_scaled**2)
+    del Y_scaled
+    
+    def factor(alpha):
+        # penalty is doubled to match the convention of statsmodels GLMGam
+        penalty = block_diag(np.zeros((k_linear, k_linear)),
+                             *[2 * a * S for a, S in zip(alpha, bs.penalty_matrices)])
+        return cho_factor(DtD + penalty, lower=True, check_finite=False)
+    
+    def gcv(log_alpha):
+        try:
+            c_and_lower = factor(np.exp(log_alpha))
+        except LinAlgError:
+            return np.inf
+        B = cho_solve(c_and_lower, DtY_scaled, check_finite=False)
+        edf = np.trace(cho_solve(c_and_lower, DtD, check_finite=False))
+        rss = YtY_scaled - 2 * np.sum(B * DtY_scaled) + np.sum(B * np.dot(DtD, B))
+        return n_sample * rss / (n_sample - edf)**2
+    
+    # start from the best weight on a coarse grid shared by all smooth terms,
+    # then refine within the bounds of the grid
+    n_terms = len(bs.penalty_matrices)
+    log_alpha_grid = np.linspace(LOG_ALPHA_BOUNDS[0], LOG_ALPHA_BOUNDS[1], 41)
+    gcv_grid = [gcv(np.full(n_terms, la)) for la in log_alpha_grid]
+    if not np.isfinite(np.min(gcv_grid)):
+        raise ValueError('GCV failed for all penalization weights. Check `smooth_terms` argument.')
+    log_alpha_start = np.full(n_terms, log_alpha_grid[np.argmin(gcv_grid)])
+    res = minimize(gcv, log_alpha_start, method='Nelder-Mead',
+                   bounds=[LOG_ALPHA_BOUNDS] * n_terms)
+    alpha = np.exp(res.x)
+    B_hat = cho_solve(factor(alpha), DtY, check_finite=False).astype(X.dtype, copy=False)
+    
+    return B_hat, alpha
+
+def fitGAMOneFeature(y, exog, bs, alpha):
+    """
+    Fit the GAM for a single feature with statsmodels, selecting the
+    penalization weights for that feature.
+    """
+    gam_bs = GLMGam(y, exog=exog, smoother=bs, alpha=alpha)
+    # Optimal penalization weights alpha can be obtained through gcv/kfold
+    # Note: kfold is faster, gcv is more robust
+    gam_bs.alpha = gam_bs.select_penweight_kfold()[0]
+    res_bs_optim = gam_bs.fit()
+    
+    return res_bs_optim.params
+
 def fitLSModelAndFindPriors(s_data, design, info_dict, eb=True):
     """
     The original neuroCombat function fit_LS_model_and_find_priors plus
@@ -202,7 +376,9 @@ def fitLSModelAndFindPriors(s_data, design, info_dict, eb=True):
     batch_info = info_dict['batch_info'] 
     
     batch_design = design[:,:n_batch]
-    gamma_hat = np.dot(np.dot(np.linalg.inv(np.dot(batch_design.T, batch_design)), batch_design.T), s_data.T)
+    # multi_dot picks the cheapest order of the matrix products
+    gamma_hat = np.linalg.multi_dot([np.linalg.inv(np.dot(batch_design.T, batch_design)),
+                                     batch_design.T, s_data.T])
 
     delta_hat = []
     for i, batch_idxs in enumerate(batch_info):
@@ -234,13 +410,38 @@ def fitLSModelAndFindPriors(s_data, design, info_dict, eb=True):
         return LS_dict
 
 
-def saveHarmonizationModel(model, file_name):
+def findParametricAdjustments(s_data, LS_dict, info_dict):
+    """
+    Dispatch to the numba implementation of find_parametric_adjustments if
+    numba is installed and there are at least NUMBA_MIN_FEATURES features,
+    otherwise use the original neuroCombat function.
+    
+    Set the environment variable NEUROHARMONIZE_DISABLE_NUMBA=1 to always
+    use the original function.
+    """
+    use_numba = (s_data.shape[0] >= NUMBA_MIN_FEATURES and
+                 os.environ.get('NEUROHARMONIZE_DISABLE_NUMBA', '0') in ('', '0'))
+    if use_numba:
+        try:
+            from .neuroCombatNumba import find_parametric_adjustments as find_adjustments
+        except ImportError:
+            find_adjustments = find_parametric_adjustments
+    else:
+        find_adjustments = find_parametric_adjustments
+    
+    return find_adjustments(s_data, LS_dict, info_dict)
+
+def saveHarmonizationModel(model, file_name, compress=False):
     """
     Save a harmonization model from harmonizationLearn().
     
     For saving model contents, this function will create a new file specified
     by file_name, and store the model using the pickle package.
     
+    If compress=True, the file is compressed with gzip. This is slower but
+    can reduce the size of large models considerably. loadHarmonizationModel()
+    reads both compressed and uncompressed files.
+    
     """
     if os.path.exists(file_name):
         raise ValueError('Model file already exists: %s. Change name or delete to save.' % file_name)
@@ -250,7 +451,10 @@ def saveHarmonizationModel(model, file_name):
                 'gamma_star', 'delta_star', 'gamma_hat', 'delta_hat']:
         est_size += model[key].nbytes / 1e6
     print('\n[neuroHarmonize]: Saving model object, estimated size in MB: %4.2f' % est_size)
-    out_file = open(file_name, 'wb')
+    if compress:
+        out_file = gzip.open(file_name, 'wb')
+    else:
+        out_file = open(file_name, 'wb')
     pickle.dump(model, out_file)
     out_file.close()
     
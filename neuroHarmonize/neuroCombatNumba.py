@@ -0,0 +1,64 @@
+"""
+Numba implementation of the ComBat empirical Bayes adjustments
+
+This module is only imported if numba is installed and the data has enough
+features to make up for compilation. Otherwise, the pure NumPy
+implementation in neuroCombat is used.
+"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def it_sol(sdat, g_hat, d_hat, g_bar, t2, a, b, conv=0.0001):
+    """
+    Same iterations as neuroCombat.it_sol, parallelized over features.
+
+    Convergence is checked over all features at once, as in the original,
+    so the estimates are identical up to floating point error.
+    """
+    n_feature, n_sample = sdat.shape
+    n = np.zeros(n_feature)
+    for i in prange(n_feature):
+        for j in range(n_sample):
+            if not np.isnan(sdat[i, j]):
+                n[i] += 1.0
+    g_old = g_hat.copy()
+    d_old = d_hat.copy()
+    g_new = np.empty(n_feature)
+    d_new = np.empty(n_feature)
+    g_change = np.empty(n_feature)
+    d_change = np.empty(n_feature)
+
+    change = 1.0
+    while change > conv:
+        for i in prange(n_feature):
+            # postmean
+            g_new[i] = (t2 * n[i] * g_hat[i] + d_old[i] * g_bar) / (t2 * n[i] + d_old[i])
+            sum2 = 0.0
+            for j in range(n_sample):
+                sum2 += (sdat[i, j] - g_new[i]) ** 2
+            # postvar
+            d_new[i] = (0.5 * sum2 + b) / (n[i] / 2.0 + a - 1.0)
+            g_change[i] = abs(g_new[i] - g_old[i]) / g_old[i]
+            d_change[i] = abs(d_new[i] - d_old[i]) / d_old[i]
+        change = max(g_change.max(), d_change.max())
+        g_old[:] = g_new
+        d_old[:] = d_new
+    return g_new, d_new
+
+def find_parametric_adjustments(s_data, LS, info_dict):
+    batch_info  = info_dict['batch_info']
+
+    gamma_star, delta_star = [], []
+    for i, batch_idxs in enumerate(batch_info):
+        temp = it_sol(np.ascontiguousarray(s_data[:,batch_idxs], dtype=np.float64),
+                      np.asarray(LS['gamma_hat'][i], dtype=np.float64),
+                      np.asarray(LS['delta_hat'][i], dtype=np.float64),
+                      float(LS['gamma_bar'][i]), float(LS['t2'][i]),
+                      float(LS['a_prior'][i]), float(LS['b_prior'][i]))
+
+        gamma_star.append(temp[0])
+        delta_star.append(temp[1])
+
+    return np.array(gamma_star), np.array(delta_star)
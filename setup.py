@@ -13,5 +13,6 @@ setup(name='neuroHarmonize',
       author_email='raymond.pomponio@outlook.edu',
       license='MIT',
       packages=['neuroHarmonize'],
-      install_requires=['numpy', 'pandas', 'nibabel', 'statsmodels>=0.11.0.dev0'],
+      install_requires=['numpy', 'scipy', 'pandas', 'nibabel', 'joblib', 'statsmodels>=0.11.0.dev0'],
+      extras_require={'numba': ['numba']},
       zip_safe=False)